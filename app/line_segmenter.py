@@ -2,60 +2,135 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
+import cv2
+import numba
 import numpy as np
 from PIL import Image
-import cv2
+
+# Pages are preprocessed from a thread pool; the default "workqueue"
+# layer aborts on concurrent parallel calls, so require a threadsafe one.
+numba.config.THREADING_LAYER = "threadsafe"
 
 
 @dataclass
 class LineImage:
-    """Represents a single line cropped from the page."""
-    image: Image.Image
+    """Represents a single line sliced from the page (a view, not a copy)."""
+    image: np.ndarray
     bbox: Tuple[int, int, int, int]  # (x1, y1, x2, y2)
 
 
-def segment_lines(page: Image.Image) -> List[LineImage]:
+@dataclass
+class PreprocessedPage:
+    """
+    A preprocessed page. ``gray`` and ``projection`` are only filled in when
+    preprocessing computed them (deskew / line segmentation).
+    """
+    pil: Image.Image
+    gray: Optional[np.ndarray] = None
+    projection: Optional[np.ndarray] = None  # ink pixels per row
+
+
+@numba.njit(parallel=True, cache=True)
+def _histogram(gray: np.ndarray, n: int) -> np.ndarray:
+    # Per-thread partial histograms over ``n`` row bands, reduced at the end.
+    # ``n`` is passed in because reading the thread count inside the kernel
+    # makes it uncacheable.
+    h, w = gray.shape
+    partial = np.zeros((n, 256), dtype=np.int64)
+    for c in numba.prange(n):
+        for y in range(c * h // n, (c + 1) * h // n):
+            for x in range(w):
+                partial[c, gray[y, x]] += 1
+    return partial.sum(axis=0)
+
+
+@numba.njit(parallel=True, cache=True)
+def _threshold_and_project(gray: np.ndarray, thresh: int):
+    # Binarize (ink -> 255) and count ink per row in the same pass
+    h, w = gray.shape
+    bw = np.empty((h, w), dtype=np.uint8)
+    projection = np.zeros(h, dtype=np.int64)
+    for y in numba.prange(h):
+        count = 0
+        for x in range(w):
+            if gray[y, x] > thresh:
+                bw[y, x] = 0
+            else:
+                bw[y, x] = 255
+                count += 1
+        projection[y] = count
+    return bw, projection
+
+
+def _otsu_threshold(hist: np.ndarray) -> float:
+    """Otsu's threshold from a 256-bin histogram (same convention as cv2)."""
+    total = hist.sum()
+    if total == 0:
+        return 0.0
+    w0 = np.cumsum(hist).astype(np.float64)
+    w1 = total - w0
+    mu = np.cumsum(hist * np.arange(256)).astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = w0 * w1 * (mu / w0 - (mu[-1] - mu) / w1) ** 2
+    return float(np.argmax(np.nan_to_num(between)))
+
+
+def scan_page(
+    gray: np.ndarray,
+    threshold: Optional[float] = None,
+) -> Tuple[float, np.ndarray, np.ndarray]:
+    """
+    Binarize a grayscale page (ink is 255 on a 0 background) and compute
+    its horizontal projection in one fused pass. Runs Otsu unless a
+    previously computed threshold is passed in.
+
+    Returns ``(threshold, bw, projection)``.
+    """
+    gray = np.ascontiguousarray(gray)
+    if threshold is None:
+        n_bands = max(1, min(numba.get_num_threads(), gray.shape[0]))
+        threshold = _otsu_threshold(_histogram(gray, n_bands))
+    bw, projection = _threshold_and_project(gray, int(threshold))
+    return threshold, bw, projection
+
+
+def segment_lines(
+    page: np.ndarray,
+    projection: Optional[np.ndarray] = None,
+) -> List[LineImage]:
     """
     Simple horizontal projection-based line segmentation.
     Not as fancy as Kraken, but works well on your samples.
-    """
-    gray = np.array(page.convert("L"))
-    # Binarize: text black on white
-    _, bw = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
 
-    # Horizontal projection: sum of ink per row
-    projection = bw.sum(axis=1)
+    Pass ``projection`` (from ``PreprocessedPage``) to skip re-binarizing
+    the page.
+    """
+    if projection is None:
+        # Binarize (text black on white) and take ink pixels per row
+        gray = page if page.ndim == 2 else cv2.cvtColor(page, cv2.COLOR_RGB2GRAY)
+        _, _, projection = scan_page(gray)
 
     # Threshold to find "ink-heavy" rows (potential text)
     thresh = projection.max() * 0.1
     is_text_row = projection > thresh
 
+    # Find contiguous runs of text rows: +1 edges start a run, -1 edges end one
+    flags = is_text_row.astype(np.int8)
+    edges = np.diff(np.concatenate(([0], flags, [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+
     lines: List[LineImage] = []
-    in_line = False
-    start_row = 0
-
-    for i, flag in enumerate(is_text_row):
-        if flag and not in_line:
-            in_line = True
-            start_row = i
-        elif not flag and in_line:
-            in_line = False
-            end_row = i
-            # Add a bit of padding
-            pad = 3
-            y1 = max(0, start_row - pad)
-            y2 = min(gray.shape[0], end_row + pad)
-            line_img = page.crop((0, y1, page.width, y2))
-            lines.append(LineImage(image=line_img, bbox=(0, y1, page.width, y2)))
-
-    # In case the last line goes to the bottom
-    if in_line:
-        pad = 3
-        y1 = max(0, start_row - pad)
-        y2 = gray.shape[0]
-        line_img = page.crop((0, y1, page.width, y2))
-        lines.append(LineImage(image=line_img, bbox=(0, y1, page.width, y2)))
+    height, width = page.shape[:2]
+    # Add a bit of padding
+    pad = 3
+
+    for start_row, end_row in zip(starts, ends):
+        y1 = max(0, int(start_row) - pad)
+        # A run reaching the bottom of the page gets no bottom padding
+        y2 = height if end_row == height else min(height, int(end_row) + pad)
+        lines.append(LineImage(image=page[y1:y2], bbox=(0, y1, width, y2)))
 
     return lines
@@ -1,32 +1,61 @@
 # app/main.py
 from __future__ import annotations
 
-import io
+import asyncio
+import contextlib
+import itertools
 import mimetypes
-from typing import List, Dict, Any, Optional
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Dict, Any, AsyncIterator, Iterable, Iterator, Optional, Tuple
 
 from fastapi import FastAPI, UploadFile, File, HTTPException, Query
 from fastapi.responses import FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 
-from pdf2image import convert_from_bytes
-from PIL import Image, ImageOps, ImageFilter
+from pdf2image import convert_from_path, pdfinfo_from_path
+from PIL import Image, ImageOps, ImageSequence
 
 import numpy as np
 import cv2
 
-from .ocr_engines import EasyOcrEngine, create_engines
+from .line_segmenter import LineImage, PreprocessedPage, scan_page
+from .ocr_engines import EasyOcrWorkerPool, create_engines
 from .trocr_engine import TrOCREngine
 
 
 app = FastAPI(title="Handwriting OCR (EasyOCR + TrOCR)")
 
 
-# Instantiate engines once
-easy_engine = EasyOcrEngine(languages=["en"])
-engine_registry = create_engines()  # {"easyocr": ..., "trocr": ...}
+# Instantiate engines once; EasyOCR runs in its own worker processes
+EASYOCR_WORKERS = int(os.environ.get("EASYOCR_WORKERS", "2"))
+engine_registry = create_engines(easyocr_workers=EASYOCR_WORKERS)  # {"easyocr": ..., "trocr": ...}
+easy_engine: EasyOcrWorkerPool = engine_registry["easyocr"]  # for simple endpoint
 trocr_engine: TrOCREngine = engine_registry["trocr"]  # for advanced endpoint
 
+# Page preprocessing is dominated by cv2/PIL ops that release the GIL,
+# so pages of one request are processed concurrently on threads.
+PREPROCESS_POOL = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+
+# A single thread owns TrOCR so batches from concurrent requests don't
+# race on the model or its result cache.
+TROCR_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+
+@app.on_event("startup")
+async def warm_up_engines():
+    # EasyOCR workers warm up as they start; TrOCR is warmed on the thread
+    # that runs it so compiled graphs / cuDNN choices are in place
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(TROCR_EXECUTOR, trocr_engine.warmup)
+    # Compile the Numba page-scan kernels now rather than on the first
+    # request; the high + segment path hits every kernel signature
+    dummy_page = Image.new("RGB", (256, 256), "white")
+    await loop.run_in_executor(PREPROCESS_POOL, preprocess_page, dummy_page, "high", True)
+
 
 # ---------- Static frontend ----------
 
@@ -54,53 +83,330 @@ def upscale(img: Image.Image, min_height: int = 1200) -> Image.Image:
     return img.resize((int(w * scale), int(h * scale)), Image.BICUBIC)
 
 
-def deskew(img: Image.Image) -> Image.Image:
-    gray = np.array(img.convert("L"))
-    _, bw = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
-    coords = np.column_stack(np.where(bw > 0))
-    if coords.size == 0:
-        return img
-    angle = cv2.minAreaRect(coords)[-1]
-    if angle < -45:
-        angle = -(90 + angle)
-    else:
-        angle = -angle
-    (h, w) = gray.shape
-    M = cv2.getRotationMatrix2D((w // 2, h // 2), angle, 1.0)
-    rotated = cv2.warpAffine(np.array(img), M, (w, h), flags=cv2.INTER_CUBIC)
-    return Image.fromarray(rotated)
+@dataclass
+class PageBuffers:
+    """
+    Scratch arrays for intermediate page images, reused across pages of the
+    same size instead of reallocating. One instance per preprocessing thread.
+    """
+    deskewed: Optional[np.ndarray] = None
+
+    def deskew_out(self, shape: Tuple[int, int]) -> np.ndarray:
+        if self.deskewed is None or self.deskewed.shape != shape:
+            self.deskewed = np.empty(shape, dtype=np.uint8)
+        return self.deskewed
+
+
+_thread_buffers = threading.local()
 
 
-def soften_background(img: Image.Image) -> Image.Image:
-    return img.filter(ImageFilter.MedianFilter(size=3))
+def page_buffers() -> PageBuffers:
+    if not hasattr(_thread_buffers, "buffers"):
+        _thread_buffers.buffers = PageBuffers()
+    return _thread_buffers.buffers
 
 
-def preprocess_page(img: Image.Image, quality: str = "fast") -> Image.Image:
+# Candidate skew angles (degrees) and the height pages are scored at
+DESKEW_ANGLES = np.arange(-5.0, 5.5, 0.5)
+DESKEW_HEIGHT = 800
+
+
+def deskew(gray: np.ndarray, bw: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Projection-profile deskew: rotate a downscaled binary page through
+    candidate angles and keep the one whose horizontal projection has the
+    highest variance (text rows line up into sharp peaks).
+
+    The rotated page is written into ``out`` when given.
+    """
+    (h, w) = gray.shape
+    scale = min(1.0, DESKEW_HEIGHT / h)
+    small = cv2.resize(bw, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+    sh, sw = small.shape
+    center = (sw // 2, sh // 2)
+
+    # Seed with the unrotated score so ties (e.g. a blank page, where every
+    # angle scores zero) leave the page as-is
+    best_angle = 0.0
+    best_score = np.count_nonzero(small, axis=1).var()
+    for angle in DESKEW_ANGLES:
+        if angle == 0.0:
+            continue
+        M = cv2.getRotationMatrix2D(center, float(angle), 1.0)
+        rotated = cv2.warpAffine(small, M, (sw, sh), flags=cv2.INTER_NEAREST)
+        score = np.count_nonzero(rotated, axis=1).var()
+        if score > best_score:
+            best_angle, best_score = float(angle), score
+
+    if best_angle == 0.0:
+        return gray
+    M = cv2.getRotationMatrix2D((w // 2, h // 2), best_angle, 1.0)
+    # Fill exposed corners with white so they don't read as ink
+    return cv2.warpAffine(gray, M, (w, h), dst=out, flags=cv2.INTER_CUBIC, borderValue=255)
+
+
+def soften_background(gray: np.ndarray) -> np.ndarray:
+    # 3x3 median; OpenCV's SIMD path is much faster than PIL's MedianFilter
+    return cv2.medianBlur(gray, 3)
+
+
+def preprocess_page(
+    img: Image.Image,
+    quality: str = "fast",
+    segment: bool = False,
+) -> PreprocessedPage:
+    """
+    Grayscale conversion and Otsu run at most once per page, and only when
+    deskew (``quality="high"``) or line segmentation (``segment=True``)
+    needs them; the gray buffer and row projection are carried along.
+    """
     img = normalize_contrast(img)
+    if quality != "high" and not segment:
+        return PreprocessedPage(pil=img)
+
+    gray = np.asarray(img)
+    projection = None
     if quality == "high":
-        img = deskew(img)
-        img = upscale(img, min_height=1500)
-        img = soften_background(img)
-    return img
+        threshold, bw, _ = scan_page(gray)
+        # The deskewed page is only an intermediate (upscale/median produce
+        # new arrays), so it goes into this thread's reusable buffer
+        gray = deskew(gray, bw, out=page_buffers().deskew_out(gray.shape))
+        del bw
+        img = upscale(Image.fromarray(gray), min_height=1500)
+        gray = soften_background(np.asarray(img))
+        img = Image.fromarray(gray)
+        if segment:
+            # Reuse the page's Otsu threshold rather than recomputing it
+            _, _, projection = scan_page(gray, threshold)
+    else:
+        _, _, projection = scan_page(gray)
+    return PreprocessedPage(pil=img, gray=gray, projection=projection)
 
 
 # ---------- File → pages helper ----------
 
-def file_to_pages(file_bytes: bytes, filename: str) -> List[Image.Image]:
+# pdftoppm rasterizes pages in parallel across this many processes
+PDF_THREAD_COUNT = max(1, (os.cpu_count() or 1) - 1)
+
+
+# Uploads are copied to disk in chunks of this size
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+
+@contextlib.asynccontextmanager
+async def saved_upload(file: UploadFile) -> AsyncIterator[str]:
+    """
+    Stream an upload to a temp file chunk by chunk and yield its path, so
+    the whole body is never held in memory and pdftoppm can read it
+    directly. The file is removed on exit.
+    """
+    suffix = os.path.splitext(file.filename or "")[1]
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                out.write(chunk)
+        if os.path.getsize(path) == 0:
+            raise HTTPException(status_code=400, detail="Empty file")
+        yield path
+    finally:
+        os.remove(path)
+
+
+# PDFs are rasterized this many pages at a time
+PDF_CHUNK_PAGES = 8
+
+
+def iter_pages(
+    path: str,
+    filename: str,
+    max_pages: Optional[int] = None,
+    chunk: int = PDF_CHUNK_PAGES,
+) -> Iterator[Image.Image]:
+    """
+    Lazily decode an upload into page images, yielding at most
+    ``max_pages``. PDFs are rendered ``chunk`` pages at a time, so memory
+    is bounded by the chunk rather than the whole document.
+    """
     mime, _ = mimetypes.guess_type(filename)
     if mime == "application/pdf" or filename.lower().endswith(".pdf"):
-        try:
-            pages = convert_from_bytes(file_bytes)
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Error reading PDF: {e}")
-        return pages
+        yield from _iter_pdf_pages(path, max_pages, chunk)
     else:
+        yield from _iter_image_frames(path, max_pages)
+
+
+def _iter_pdf_pages(path: str, max_pages: Optional[int], chunk: int) -> Iterator[Image.Image]:
+    try:
+        page_count = pdfinfo_from_path(path)["Pages"]
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Error reading PDF: {e}")
+    last_page = page_count if max_pages is None else min(page_count, max_pages)
+
+    for first_page in range(1, last_page + 1, chunk):
         try:
-            img = Image.open(io.BytesIO(file_bytes))
-            img.load()
+            # Render to a temp folder instead of piping PPMs through memory;
+            # pages are loaded before the folder is cleaned up.
+            with tempfile.TemporaryDirectory() as tmp:
+                pages = convert_from_path(
+                    path,
+                    dpi=200,
+                    fmt="jpeg",
+                    thread_count=PDF_THREAD_COUNT,
+                    output_folder=tmp,
+                    first_page=first_page,
+                    last_page=min(first_page + chunk - 1, last_page),
+                )
+                for page in pages:
+                    page.load()
         except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Invalid image file: {e}")
-        return [img]
+            raise HTTPException(status_code=400, detail=f"Error reading PDF: {e}")
+        yield from pages
+        del pages
+
+
+# Image formats whose extra frames are document pages. Others (e.g. MPO
+# camera JPEGs with an embedded preview) only contribute their first frame.
+MULTI_PAGE_FORMATS = {"TIFF"}
+
+
+def _iter_image_frames(path: str, max_pages: Optional[int]) -> Iterator[Image.Image]:
+    # Multi-page images (TIFF) yield one page per frame
+    try:
+        img = Image.open(path)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid image file: {e}")
+    with img:
+        if img.format not in MULTI_PAGE_FORMATS:
+            max_pages = 1
+        frames = itertools.islice(ImageSequence.Iterator(img), max_pages)
+        while True:
+            try:
+                frame = next(frames, None)
+                if frame is None:
+                    break
+                page = frame.copy()
+            except Exception as e:
+                raise HTTPException(status_code=400, detail=f"Invalid image file: {e}")
+            yield page
+
+
+# ---------- TrOCR pipeline ----------
+
+# Max pages buffered between pipeline stages
+PIPELINE_QUEUE_SIZE = 4
+# Flush a partial TrOCR batch once its oldest line has waited this long (s)
+BATCH_MAX_WAIT = 0.05
+
+
+async def run_trocr_pipeline(
+    pages: Iterable[Image.Image],
+    quality: str,
+) -> List[Dict[str, Any]]:
+    """
+    decode -> preprocess -> TrOCR as three overlapping stages linked by
+    bounded queues, so rasterizing, preprocessing and recognition of
+    different pages run concurrently.
+    """
+    loop = asyncio.get_running_loop()
+    decoded: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    segmented: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+
+    def preprocess_and_segment(page: Image.Image) -> List[LineImage]:
+        return trocr_engine.segment(preprocess_page(page, quality=quality, segment=True))
+
+    async def decode_stage() -> None:
+        # Pull pages on a worker thread so lazy page sources don't block
+        page_iter = iter(pages)
+        while True:
+            page = await loop.run_in_executor(PREPROCESS_POOL, next, page_iter, None)
+            if page is None:
+                break
+            await decoded.put(page)
+        await decoded.put(None)
+
+    async def preprocess_stage() -> None:
+        # Push futures rather than results: pages in flight preprocess in
+        # parallel on the pool while order is preserved for the consumer
+        while (page := await decoded.get()) is not None:
+            await segmented.put(
+                loop.run_in_executor(PREPROCESS_POOL, preprocess_and_segment, page)
+            )
+        await segmented.put(None)
+
+    # Only bboxes are kept once a line is recognised: line images are views
+    # into their page's gray buffer, so holding them would keep every page
+    # of the request alive until the end
+    bboxes: List[Tuple[int, Tuple[int, int, int, int]]] = []
+    texts: List[str] = []
+    n_pages = 0
+
+    async def recognize_stage() -> None:
+        nonlocal n_pages
+        pending: List[Tuple[int, LineImage]] = []
+        deadline = 0.0
+
+        async def flush(batch: List[Tuple[int, LineImage]]) -> None:
+            batch_texts = await loop.run_in_executor(
+                TROCR_EXECUTOR,
+                trocr_engine.recognize_lines,
+                [line.image for _, line in batch],
+            )
+            bboxes.extend((page_slot, line.bbox) for page_slot, line in batch)
+            texts.extend(batch_texts)
+
+        def time_left() -> Optional[float]:
+            return max(0.0, deadline - loop.time()) if pending else None
+
+        # Batch when the queue hits batch_size or the oldest line waited
+        # BATCH_MAX_WAIT. The deadline covers both waiting for the next page
+        # and waiting for that page to finish preprocessing.
+        page_future: Optional[asyncio.Future] = None
+        while True:
+            if page_future is None:
+                try:
+                    page_future = await asyncio.wait_for(segmented.get(), time_left())
+                except asyncio.TimeoutError:
+                    await flush(pending)
+                    pending = []
+                    continue
+                if page_future is None:
+                    break
+
+            done, _ = await asyncio.wait({page_future}, timeout=time_left())
+            if not done:
+                # Page still preprocessing: flush what we have, keep waiting
+                await flush(pending)
+                pending = []
+                continue
+            lines = page_future.result()
+            page_future = None
+
+            if lines and not pending:
+                deadline = loop.time() + BATCH_MAX_WAIT
+            pending.extend((n_pages, line) for line in lines)
+            n_pages += 1
+
+            while len(pending) >= trocr_engine.batch_size:
+                batch, pending = pending[:trocr_engine.batch_size], pending[trocr_engine.batch_size:]
+                await flush(batch)
+                deadline = loop.time() + BATCH_MAX_WAIT
+
+        if pending:
+            await flush(pending)
+
+    tasks = [
+        asyncio.ensure_future(decode_stage()),
+        asyncio.ensure_future(preprocess_stage()),
+        asyncio.ensure_future(recognize_stage()),
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # If one stage fails, don't leave the others blocked on a queue
+        for task in tasks:
+            task.cancel()
+
+    return trocr_engine.build_page_results(n_pages, bboxes, texts)
 
 
 # ---------- API ----------
@@ -122,25 +428,29 @@ async def run_ocr_simple(
     quality: str = Query(
         default="fast",
         regex="^(fast|high)$",
-        description="Preprocessing quality: 'fast' or 'high'",
+        description="Quality: 'fast' or 'high' (preprocessing and EasyOCR decoder)",
     ),
 ):
     """
     Simple OCR endpoint: preprocessing + EasyOCR full-page.
     """
-    file_bytes = await file.read()
-    if not file_bytes:
-        raise HTTPException(status_code=400, detail="Empty file")
-
-    pages = file_to_pages(file_bytes, file.filename)
-    if not pages:
+    loop = asyncio.get_running_loop()
+    async with saved_upload(file) as path:
+        # Decode and preprocess on the pool so the event loop stays free;
+        # pages preprocess concurrently while later ones are still decoding
+        pages = iter_pages(path, file.filename, max_pages=max_pages)
+        pending = []
+        while (page := await loop.run_in_executor(PREPROCESS_POOL, next, pages, None)) is not None:
+            pending.append(loop.run_in_executor(PREPROCESS_POOL, preprocess_page, page, quality))
+        processed_pages = await asyncio.gather(*pending)
+    if not processed_pages:
         raise HTTPException(status_code=400, detail="No pages found in file")
 
-    pages = pages[:max_pages]
-    processed_pages = [preprocess_page(p, quality=quality) for p in pages]
-
     try:
-        page_results = easy_engine.ocr_pages(processed_pages)
+        page_results = await easy_engine.ocr_pages_async(
+            [p.pil for p in processed_pages],
+            quality=quality,
+        )
     except Exception as e:
         # Surface the real error instead of opaque 500
         raise HTTPException(
@@ -165,27 +475,23 @@ async def run_ocr_advanced(
     ),
 ):
     """
-    Advanced handwriting pipeline:
+    Advanced handwriting pipeline (stages overlap across pages):
       - preprocessing
       - line segmentation
-      - TrOCR handwritten model per line
+      - TrOCR handwritten model, batched across lines
     """
-    file_bytes = await file.read()
-    if not file_bytes:
-        raise HTTPException(status_code=400, detail="Empty file")
-
-    pages = file_to_pages(file_bytes, file.filename)
-    if not pages:
+    async with saved_upload(file) as path:
+        # Pages are decoded lazily as the pipeline pulls them
+        pages = iter_pages(path, file.filename, max_pages=max_pages)
+        try:
+            trocr_pages = await run_trocr_pipeline(pages, quality=quality)
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"OCR failed for TrOCR: {e}")
+    if not trocr_pages:
         raise HTTPException(status_code=400, detail="No pages found in file")
 
-    pages = pages[:max_pages]
-    processed_pages = [preprocess_page(p, quality=quality) for p in pages]
-
-    try:
-        trocr_pages = trocr_engine.ocr_pages(processed_pages)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"OCR failed for TrOCR: {e}")
-
     # Flatten per-page lines into a nicer shape:
     # { "trocr": [ {page, lines: [{bbox, text}, ...]}, ... ] }
     return JSONResponse({"file_name": file.filename, "models": {"trocr": trocr_pages}})